@@ -34,7 +34,7 @@ def get_list_members(list_id, page=1, count=DEFAULT_BULK_MEMBER_COUNT, since_las
         'fields': 'members.id,members.status,members.email_address,members.merge_fields.FNAME,'
                   'members.merge_fields.LNAME',
         'count': count,
-        'offset': page * count,
+        'offset': (page - 1) * count,
         'since_last_changed': since_last_changed
     }
 
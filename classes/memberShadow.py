@@ -0,0 +1,38 @@
+import hashlib
+import json
+
+# Bucket digests are the sum of the digests of their members, so that they can be computed
+# incrementally while scanning a list, regardless of the order in which members are returned
+DIGEST_MODULUS = 2 ** 256
+
+
+class MemberShadowError(Exception):
+    pass
+
+
+def bucket_of(member_id, bucket_count):
+    # The first 32 bits of the id hash are mapped onto bucket_count contiguous ranges
+    id_hash = int(hashlib.md5(member_id.encode('utf-8')).hexdigest()[:8], 16)
+    return (id_hash * bucket_count) >> 32
+
+
+def member_fingerprint(ometria_member):
+    # A short, stable hash of the record as it is sent to Ometria
+    payload = json.dumps(ometria_member.to_dict(), sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def member_digest(member_id, fingerprint):
+    return int(hashlib.sha256(f"{member_id}:{fingerprint}".encode('utf-8')).hexdigest(), 16)
+
+
+def add_member_digest(bucket_digest, member_id, fingerprint):
+    return (bucket_digest + member_digest(member_id, fingerprint)) % DIGEST_MODULUS
+
+
+def bucket_digest(bucket_members):
+    # bucket_members maps every member id of the bucket to its fingerprint
+    digest = 0
+    for member_id, fingerprint in bucket_members.items():
+        digest = add_member_digest(digest, member_id, fingerprint)
+    return digest
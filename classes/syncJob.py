@@ -9,14 +9,19 @@ class Status(Enum):
 
 
 class JobDetails:
-    def __init__(self, list_id, last_sync_date_time):
+    def __init__(self, list_id, last_sync_date_time, last_reconciliation_date_time=None,
+                 last_reconciliation_attempt_date_time=None):
         self.list_id = list_id
         self.last_sync_date_time = last_sync_date_time
+        self.last_reconciliation_date_time = last_reconciliation_date_time
+        self.last_reconciliation_attempt_date_time = last_reconciliation_attempt_date_time
 
     def to_dict(self):
         return {
             "listId": self.list_id,
-            "last_sync_date_time": self.last_sync_date_time
+            "last_sync_date_time": self.last_sync_date_time,
+            "last_reconciliation_date_time": self.last_reconciliation_date_time,
+            "last_reconciliation_attempt_date_time": self.last_reconciliation_attempt_date_time
         }
 
 
@@ -2,6 +2,7 @@ import argparse
 import json
 import math
 import os
+import shutil
 import threading
 import time
 import concurrent.futures
@@ -10,6 +11,8 @@ from datetime import datetime, timedelta
 from api.mailchimpAPIModule import get_list_members, get_list_members_count
 from api.ometriaAPIModule import create_or_update_members
 from api.requestsModule import APIRequestError
+from classes.memberShadow import (MemberShadowError, bucket_of, member_fingerprint, add_member_digest,
+                                  bucket_digest)
 from classes.syncJob import SyncJob, Status, JobDetails
 from logger.loggingModule import logger
 from utils.utils import mailchimp_member_to_ometria_member, SyncJobEncoder
@@ -23,8 +26,15 @@ MINUTES_NEEDED_TO_PERFORM_A_PARTIAL_SYNC_OF_A_SINGLE_BULK = int(
 NUMBER_OF_MINUTES_THAT_OMETRIAS_DATA_IS_BEHIND_MAILCHIMPS_DATA = int(
     os.getenv("NUMBER_OF_MINUTES_THAT_OMETRIAS_DATA_IS_BEHIND_MAILCHIMPS_DATA", "120"))
 POLLING_TIME_IN_SECONDS = int(os.getenv("POLLING_TIME_IN_SECONDS", "60"))
+MINUTES_BETWEEN_RECONCILIATIONS = int(os.getenv("MINUTES_BETWEEN_RECONCILIATIONS", "1440"))
+MINUTES_BETWEEN_RECONCILIATION_ATTEMPTS = int(os.getenv("MINUTES_BETWEEN_RECONCILIATION_ATTEMPTS", "60"))
+MAX_NUMBER_OF_CONCURRENT_RUNNING_RECONCILIATIONS = int(
+    os.getenv("MAX_NUMBER_OF_CONCURRENT_RUNNING_RECONCILIATIONS", "1"))
+NUMBER_OF_MEMBER_SHADOW_BUCKETS = int(os.getenv("NUMBER_OF_MEMBER_SHADOW_BUCKETS", "1024"))
+MAX_NUMBER_OF_MEMBERS_KEPT_IN_MEMORY = int(os.getenv("MAX_NUMBER_OF_MEMBERS_KEPT_IN_MEMORY", "500000"))
 
 PERSISTENCE_JOBS_FILE_NAME = "sync_jobs.json"
+PERSISTENCE_MEMBER_SHADOW_DIRECTORY_NAME = "member_shadow_{}"
 
 
 def sync_job_logic(job_details: JobDetails):
@@ -56,6 +66,7 @@ def sync_job_logic(job_details: JobDetails):
 
             # Uploading the members to ometria endpoint
             create_or_update_members(ometria_members_to_add)
+            record_pushed_members(job_details, ometria_members_to_add)
             ometria_members_to_add.clear()
         return True
     except APIRequestError as e:
@@ -63,13 +74,137 @@ def sync_job_logic(job_details: JobDetails):
         return False
 
 
+def record_pushed_members(job_details: JobDetails, ometria_members):
+    # Every member that is pushed to ometria is appended to its bucket in the list's shadow, so that a
+    # later reconciliation can tell what ometria is supposed to hold. The shadow is only there for the
+    # reconciliation, so failing to update it must not fail the sync: the next reconciliation is requested
+    # instead, and it repairs the shadow.
+    try:
+        migrate_member_shadow(job_details.list_id)
+
+        bucket_updates = {}
+        for ometria_member in ometria_members:
+            bucket = bucket_of(ometria_member.id, NUMBER_OF_MEMBER_SHADOW_BUCKETS)
+            bucket_updates.setdefault(bucket, {})[ometria_member.id] = member_fingerprint(ometria_member)
+
+        # The digests of the buckets are cleared before they change, so that they're computed again
+        # by the next reconciliation
+        digests = open_member_shadow_digests(job_details.list_id)
+        for bucket in bucket_updates:
+            digests[bucket] = None
+        save_member_shadow_digests(job_details.list_id, digests)
+
+        for bucket, bucket_members in bucket_updates.items():
+            append_member_shadow_bucket(job_details.list_id, bucket, bucket_members)
+    except (MemberShadowError, OSError) as e:
+        logger.log_error(f"Member shadow of list {job_details.list_id} could not be updated, "
+                         f"a reconciliation is needed: {e}")
+        job_details.last_reconciliation_date_time = None
+
+
+def reconcile_job_logic(job_details: JobDetails):
+    # Instead of trusting since_last_changed, the whole list is scanned and compared with the shadow
+    # of what was pushed to ometria, bucket by bucket. Only the members of the buckets whose digests
+    # differ are compared one by one, and only the ones that differ are pushed again.
+    try:
+        migrate_member_shadow(job_details.list_id)
+        stored_digests = refresh_member_shadow_digests(job_details.list_id)
+
+        # The first scan only keeps a digest and a member count per bucket
+        scanned_digests = [0] * NUMBER_OF_MEMBER_SHADOW_BUCKETS
+        scanned_member_counts = [0] * NUMBER_OF_MEMBER_SHADOW_BUCKETS
+        for ometria_member in scan_list_members(job_details.list_id):
+            bucket = bucket_of(ometria_member.id, NUMBER_OF_MEMBER_SHADOW_BUCKETS)
+            scanned_digests[bucket] = add_member_digest(scanned_digests[bucket], ometria_member.id,
+                                                        member_fingerprint(ometria_member))
+            scanned_member_counts[bucket] += 1
+
+        differing_buckets = [bucket for bucket in range(NUMBER_OF_MEMBER_SHADOW_BUCKETS)
+                             if scanned_digests[bucket] != stored_digests[bucket]]
+        logger.log_info(
+            f"List {job_details.list_id} has {len(differing_buckets)} out of {NUMBER_OF_MEMBER_SHADOW_BUCKETS} "
+            f"buckets that differ from what was pushed to ometria.")
+
+        # The differing buckets are then reconciled in groups that fit in memory, each one with its own scan
+        bucket_group = []
+        bucket_group_member_count = 0
+        for bucket in differing_buckets:
+            if len(bucket_group) > 0 and \
+                    bucket_group_member_count + scanned_member_counts[bucket] > MAX_NUMBER_OF_MEMBERS_KEPT_IN_MEMORY:
+                reconcile_member_shadow_buckets(job_details.list_id, bucket_group)
+                bucket_group = []
+                bucket_group_member_count = 0
+            bucket_group.append(bucket)
+            bucket_group_member_count += scanned_member_counts[bucket]
+
+        if len(bucket_group) > 0:
+            reconcile_member_shadow_buckets(job_details.list_id, bucket_group)
+        return True
+    except APIRequestError as e:
+        print(f"API request failed: {e}")
+        return False
+    except MemberShadowError as e:
+        logger.log_error(f"Member shadow of list {job_details.list_id} could not be reconciled: {e}")
+        return False
+
+
+def reconcile_member_shadow_buckets(list_id, buckets):
+    stored_buckets = {bucket: open_member_shadow_bucket(list_id, bucket) for bucket in buckets}
+    scanned_buckets = {bucket: {} for bucket in buckets}
+    ometria_members_to_add = []
+    number_of_pushed_members = 0
+
+    for ometria_member in scan_list_members(list_id):
+        bucket = bucket_of(ometria_member.id, NUMBER_OF_MEMBER_SHADOW_BUCKETS)
+        if bucket not in scanned_buckets:
+            continue
+
+        fingerprint = member_fingerprint(ometria_member)
+        scanned_buckets[bucket][ometria_member.id] = fingerprint
+        if stored_buckets[bucket].get(ometria_member.id) != fingerprint:
+            ometria_members_to_add.append(ometria_member)
+
+        if len(ometria_members_to_add) == BULK_MEMBER_COUNT:
+            create_or_update_members(ometria_members_to_add)
+            number_of_pushed_members += len(ometria_members_to_add)
+            ometria_members_to_add.clear()
+
+    create_or_update_members(ometria_members_to_add)
+    number_of_pushed_members += len(ometria_members_to_add)
+    logger.log_info(f"Reconciled {len(buckets)} buckets of list {list_id}, {number_of_pushed_members} members "
+                    f"were pushed again.")
+
+    # The buckets are only replaced once all of their members have reached ometria, so a failure
+    # before this point leaves them as they were
+    digests = open_member_shadow_digests(list_id)
+    for bucket, bucket_members in scanned_buckets.items():
+        save_member_shadow_bucket(list_id, bucket, bucket_members)
+        digests[bucket] = bucket_digest(bucket_members)
+    save_member_shadow_digests(list_id, digests)
+
+
+def scan_list_members(list_id):
+    number_of_members = get_list_members_count(list_id)
+    number_of_member_pages_to_request = math.ceil(number_of_members / BULK_MEMBER_COUNT)
+
+    for request_page in range(1, number_of_member_pages_to_request + 1, 1):
+        member_list = get_list_members(list_id, page=request_page, count=BULK_MEMBER_COUNT, since_last_changed=None)
+        for mailchimp_member in member_list.get('members'):
+            yield mailchimp_member_to_ometria_member(mailchimp_member)
+
+
 def launch_sync_job(sync_job: SyncJob):
     logger.log_info(
         f"Thread {threading.current_thread().getName()}: Starting sync on list {sync_job.job_details.list_id}.")
 
     old_sync_date_time = sync_job.job_details.last_sync_date_time
+    old_reconciliation_date_time = sync_job.job_details.last_reconciliation_date_time
     # We want to keep track of the precise datetime when the sync job was started
     new_sync_date_time = datetime.now().isoformat()
+    if old_sync_date_time is None:
+        # A full sync fills the shadow, so there is nothing to reconcile right after it
+        # (unless the shadow fails to be updated, in which case sync_job_logic clears it again)
+        sync_job.job_details.last_reconciliation_date_time = new_sync_date_time
     job_successful = sync_job_logic(sync_job.job_details)
 
     sync_job.job_details.last_sync_date_time = new_sync_date_time
@@ -78,10 +213,46 @@ def launch_sync_job(sync_job: SyncJob):
     if not job_successful:
         # If the sync failed, we have to roll back to the last sync time
         sync_job.job_details.last_sync_date_time = old_sync_date_time
+        sync_job.job_details.last_reconciliation_date_time = old_reconciliation_date_time
 
     return sync_job
 
 
+def launch_reconciliation(sync_job: SyncJob):
+    logger.log_info(
+        f"Thread {threading.current_thread().getName()}: Starting reconciliation on list {sync_job.job_details.list_id}.")
+
+    # The attempt is recorded whatever its outcome, so that a failing reconciliation is not retried on every poll
+    new_reconciliation_date_time = datetime.now().isoformat()
+    sync_job.job_details.last_reconciliation_attempt_date_time = new_reconciliation_date_time
+    if reconcile_job_logic(sync_job.job_details):
+        sync_job.job_details.last_reconciliation_date_time = new_reconciliation_date_time
+
+    return sync_job
+
+
+def launch_reconciliations(jobs, reconciliation_results, executor):
+    # Reconciliations run in their own thread pool, so that the sync loop never waits for them
+    for list_id, sync_job in jobs.items():
+        if list_id not in reconciliation_results and is_reconciliation_needed(sync_job):
+            reconciliation_results[list_id] = executor.submit(launch_reconciliation, sync_job)
+    return reconciliation_results
+
+
+def collect_reconciliations(jobs, reconciliation_results):
+    # Only the reconciliations that are done are collected, the others are left running
+    for list_id, future in list(reconciliation_results.items()):
+        if not future.done():
+            continue
+        try:
+            jobs[list_id] = future.result()
+            print(f"Reconciliation result for list_id {list_id}: {jobs[list_id].to_dict()}")
+        except Exception as e:
+            print(f"Reconciliation error for list_id {list_id}: {e}")
+        del reconciliation_results[list_id]
+    return jobs, reconciliation_results
+
+
 def launch_sync_jobs(jobs):
     # Used to manage a pool of worker threads that can execute tasks concurrently.
     # max_workers specifies the maximum number of worker threads that can run concurrently
@@ -136,7 +307,9 @@ def open_jobs_dict(id_lists, filename):
         with open(filename, 'r') as file:
             jobs_json = json.load(file)
             for list_id, job_json in jobs_json.items():
-                job_details = JobDetails(list_id, job_json.get('job_details').get('last_sync_date_time'))
+                job_details = JobDetails(list_id, job_json.get('job_details').get('last_sync_date_time'),
+                                         job_json.get('job_details').get('last_reconciliation_date_time'),
+                                         job_json.get('job_details').get('last_reconciliation_attempt_date_time'))
                 # Fill out the jobs dictionary with the newly parsed job
                 jobs[list_id] = SyncJob(job_details=job_details, status=Status(job_json.get('status')))
             if len(jobs) < 0:
@@ -163,6 +336,173 @@ def save_jobs_dict(jobs, filename):
         json.dump(jobs, file, indent=4, cls=SyncJobEncoder)
 
 
+def member_shadow_directory(list_id, bucket_count):
+    # Shadows with different numbers of buckets are kept apart, see migrate_member_shadow
+    return os.path.join(PERSISTENCE_MEMBER_SHADOW_DIRECTORY_NAME.format(list_id), str(bucket_count))
+
+
+def member_shadow_bucket_file_name(list_id, bucket, bucket_count):
+    return os.path.join(member_shadow_directory(list_id, bucket_count), f"bucket_{bucket}.jsonl")
+
+
+def member_shadow_digests_file_name(list_id, bucket_count):
+    return os.path.join(member_shadow_directory(list_id, bucket_count), "digests.json")
+
+
+def save_member_shadow_file(filename, content):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # The file is written next to its destination and then moved, so it's never left half written
+    temporary_filename = filename + ".tmp"
+    with open(temporary_filename, 'w') as file:
+        file.write(content)
+    os.replace(temporary_filename, filename)
+
+
+def open_member_shadow_bucket(list_id, bucket, bucket_count=None):
+    # A bucket is a log of [member_id, fingerprint] lines, where the last line of a member wins
+    filename = member_shadow_bucket_file_name(list_id, bucket, bucket_count or NUMBER_OF_MEMBER_SHADOW_BUCKETS)
+    bucket_members = {}
+    try:
+        with open(filename, 'r') as file:
+            for line in file:
+                try:
+                    member_id, fingerprint = json.loads(line)
+                except (ValueError, TypeError) as e:
+                    # Only the very last line can be cut short, by a crash in the middle of an append
+                    if not line.endswith("\n"):
+                        break
+                    raise MemberShadowError(f"Member shadow file {filename} is corrupt: {e}")
+                bucket_members[member_id] = fingerprint
+    except FileNotFoundError:
+        pass
+    return bucket_members
+
+
+def save_member_shadow_bucket(list_id, bucket, bucket_members, bucket_count=None):
+    filename = member_shadow_bucket_file_name(list_id, bucket, bucket_count or NUMBER_OF_MEMBER_SHADOW_BUCKETS)
+    save_member_shadow_file(filename, "".join(json.dumps([member_id, fingerprint]) + "\n"
+                                              for member_id, fingerprint in bucket_members.items()))
+
+
+def append_member_shadow_bucket(list_id, bucket, bucket_members, bucket_count=None):
+    # Appending only costs as much as the members that were pushed, the log is compacted by the reconciliation
+    filename = member_shadow_bucket_file_name(list_id, bucket, bucket_count or NUMBER_OF_MEMBER_SHADOW_BUCKETS)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'ab+') as file:
+        file.seek(0, os.SEEK_END)
+        if file.tell() > 0:
+            file.seek(-1, os.SEEK_END)
+            if file.read(1) != b"\n":
+                # A previous append was cut short, its last line is dropped before appending
+                file.seek(0)
+                file.truncate(file.read().rfind(b"\n") + 1)
+        file.write("".join(json.dumps([member_id, fingerprint]) + "\n"
+                           for member_id, fingerprint in bucket_members.items()).encode('utf-8'))
+
+
+def open_member_shadow_digests(list_id, bucket_count=None):
+    # A digest is None when its bucket has changed since the digest was computed
+    bucket_count = bucket_count or NUMBER_OF_MEMBER_SHADOW_BUCKETS
+    filename = member_shadow_digests_file_name(list_id, bucket_count)
+    try:
+        with open(filename, 'r') as file:
+            digests_json = json.load(file)
+    except FileNotFoundError:
+        return [None] * bucket_count
+    except json.JSONDecodeError as e:
+        raise MemberShadowError(f"Member shadow file {filename} is corrupt: {e}")
+
+    if not isinstance(digests_json, list) or len(digests_json) != bucket_count:
+        raise MemberShadowError(f"Member shadow file {filename} does not hold {bucket_count} digests")
+    try:
+        return [None if digest is None else int(digest, 16) for digest in digests_json]
+    except (TypeError, ValueError) as e:
+        raise MemberShadowError(f"Member shadow file {filename} is corrupt: {e}")
+
+
+def save_member_shadow_digests(list_id, digests, bucket_count=None):
+    filename = member_shadow_digests_file_name(list_id, bucket_count or NUMBER_OF_MEMBER_SHADOW_BUCKETS)
+    save_member_shadow_file(filename, json.dumps([None if digest is None else format(digest, 'x')
+                                                  for digest in digests]))
+
+
+def refresh_member_shadow_digests(list_id):
+    # The buckets whose digests were cleared are compacted and their digests computed again, one bucket
+    # at a time. As this runs ahead of a reconciliation, corrupt files are reported and rebuilt from the
+    # scan instead of failing it: a corrupt bucket is dropped, so its members are pushed again.
+    try:
+        digests = open_member_shadow_digests(list_id)
+    except MemberShadowError as e:
+        logger.log_error(f"{e}, the digests of list {list_id} are computed again")
+        digests = [None] * NUMBER_OF_MEMBER_SHADOW_BUCKETS
+
+    for bucket in range(NUMBER_OF_MEMBER_SHADOW_BUCKETS):
+        if digests[bucket] is not None:
+            continue
+        try:
+            bucket_members = open_member_shadow_bucket(list_id, bucket)
+        except MemberShadowError as e:
+            logger.log_error(f"{e}, its members are pushed again")
+            bucket_members = {}
+        if len(bucket_members) > 0 or os.path.exists(member_shadow_bucket_file_name(
+                list_id, bucket, NUMBER_OF_MEMBER_SHADOW_BUCKETS)):
+            save_member_shadow_bucket(list_id, bucket, bucket_members)
+        digests[bucket] = bucket_digest(bucket_members)
+
+    save_member_shadow_digests(list_id, digests)
+    return digests
+
+
+def migrate_member_shadow(list_id):
+    # When NUMBER_OF_MEMBER_SHADOW_BUCKETS changes, the members of the shadow are appended to their new
+    # buckets one old bucket at a time, and the new digests are left to the next reconciliation
+    list_directory = PERSISTENCE_MEMBER_SHADOW_DIRECTORY_NAME.format(list_id)
+    if not os.path.isdir(list_directory):
+        return
+
+    old_bucket_counts = [int(name) for name in os.listdir(list_directory)
+                         if name.isdigit() and int(name) != NUMBER_OF_MEMBER_SHADOW_BUCKETS]
+    for old_bucket_count in old_bucket_counts:
+        logger.log_info(f"Moving member shadow of list {list_id} from {old_bucket_count} to "
+                        f"{NUMBER_OF_MEMBER_SHADOW_BUCKETS} buckets")
+        save_member_shadow_digests(list_id, [None] * NUMBER_OF_MEMBER_SHADOW_BUCKETS)
+        for old_bucket in range(old_bucket_count):
+            bucket_updates = {}
+            for member_id, fingerprint in open_member_shadow_bucket(list_id, old_bucket, old_bucket_count).items():
+                bucket = bucket_of(member_id, NUMBER_OF_MEMBER_SHADOW_BUCKETS)
+                bucket_updates.setdefault(bucket, {})[member_id] = fingerprint
+            for bucket, bucket_members in bucket_updates.items():
+                append_member_shadow_bucket(list_id, bucket, bucket_members)
+
+        # The old shadow is only removed once it has been fully moved, so an interrupted move is done again
+        shutil.rmtree(os.path.join(list_directory, str(old_bucket_count)))
+
+
+def is_reconciliation_needed(job: SyncJob):
+    # A list is only reconciled once it has been synced, which is what fills its shadow
+    if job.job_details.last_sync_date_time is None:
+        return False
+
+    # This is the scenario where the last reconciliation failed, it is retried after a while only
+    last_reconciliation_attempt_date_time = job.job_details.last_reconciliation_attempt_date_time
+    if last_reconciliation_attempt_date_time is not None:
+        last_attempt_time_difference_from_now = datetime.now() - datetime.fromisoformat(
+            last_reconciliation_attempt_date_time)
+        if last_attempt_time_difference_from_now < timedelta(minutes=MINUTES_BETWEEN_RECONCILIATION_ATTEMPTS):
+            return False
+
+    last_reconciliation_date_time = job.job_details.last_reconciliation_date_time
+
+    # This is the scenario where a list was synced before its shadow was kept, or where its shadow
+    # could not be updated
+    if last_reconciliation_date_time is None:
+        return True
+
+    last_reconciliation_time_difference_from_now = datetime.now() - datetime.fromisoformat(
+        last_reconciliation_date_time)
+    return last_reconciliation_time_difference_from_now > timedelta(minutes=MINUTES_BETWEEN_RECONCILIATIONS)
+
+
 def is_sync_needed(job: SyncJob):
     last_sync_date_time = job.job_details.last_sync_date_time
     sync_needed_due_to_never_having_been_synced = last_sync_date_time is None
@@ -202,12 +542,23 @@ def main(id_lists):
     jobs = open_jobs_dict(id_lists, PERSISTENCE_JOBS_FILE_NAME)
     jobs_that_need_sync = {}
 
+    # Reconciliations can take as long as a few scans of a list, so they're left running across polls
+    reconciliation_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=MAX_NUMBER_OF_CONCURRENT_RUNNING_RECONCILIATIONS)
+    reconciliation_results = {}
+
     while 1:
+        running_reconciliations = set(reconciliation_results)
+        (jobs, reconciliation_results) = collect_reconciliations(jobs, reconciliation_results)
+
         for (list_id, job) in jobs.items():
-            if is_sync_needed(job):
+            # A list is not synced while it is reconciled, as both would update its shadow. Its changes
+            # are picked up by the first sync after the reconciliation.
+            if list_id not in reconciliation_results and is_sync_needed(job):
                 # We've found a job that needs to be synced
                 jobs_that_need_sync[list_id] = job
-        if len(jobs_that_need_sync) > 0:
+        jobs_were_synced = len(jobs_that_need_sync) > 0
+        if jobs_were_synced:
             (jobs_that_need_sync, results) = launch_sync_jobs(jobs_that_need_sync)
             jobs_that_need_sync = wait_sync_jobs(jobs_that_need_sync, results)
 
@@ -217,11 +568,14 @@ def main(id_lists):
 
             # Clear the help dict of all the newly synced jobs
             jobs_that_need_sync.clear()
-
-            # Persist the new information
-            save_jobs_dict(jobs, PERSISTENCE_JOBS_FILE_NAME)
         else:
             logger.log_info("Nothing to do, sleeping...")
+
+        reconciliation_results = launch_reconciliations(jobs, reconciliation_results, reconciliation_executor)
+
+        # Persist the new information, including the reconciliations that were started or have finished
+        if jobs_were_synced or set(reconciliation_results) != running_reconciliations:
+            save_jobs_dict(jobs, PERSISTENCE_JOBS_FILE_NAME)
         time.sleep(POLLING_TIME_IN_SECONDS)
 
 
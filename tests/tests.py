@@ -1,16 +1,35 @@
+import concurrent.futures
+import os
+import tempfile
+import threading
 import unittest
-from datetime import datetime
+from datetime import datetime, timedelta
 from unittest.mock import patch, Mock
 
+from api.mailchimpAPIModule import get_list_members
 from api.requestsModule import APIRequestError
+from classes.memberShadow import MemberShadowError, bucket_of, bucket_digest, member_fingerprint
+from utils.utils import mailchimp_member_to_ometria_member
 from syncModule import (
     MAX_NUMBER_OF_CONCURRENT_RUNNING_THREADS,
     BULK_MEMBER_COUNT,
     sync_job_logic,
     launch_sync_job,
+    reconcile_job_logic,
     launch_sync_jobs,
     wait_sync_jobs,
     open_jobs_dict,
+    is_reconciliation_needed,
+    launch_reconciliations,
+    collect_reconciliations,
+    record_pushed_members,
+    member_shadow_bucket_file_name,
+    open_member_shadow_bucket,
+    append_member_shadow_bucket,
+    open_member_shadow_digests,
+    save_member_shadow_digests,
+    refresh_member_shadow_digests,
+    migrate_member_shadow,
     SyncJob,
     Status,
     JobDetails,
@@ -51,9 +70,34 @@ EXAMPLE_LIST_ID = "1a2d7ebf82"
 EXAMPLE_LIST_ID_2 = "829e85fee6"
 EXAMPLE_DATETIME = "2023-09-14T10:00:00+00:00"
 EXAMPLE_JOB_DETAILS = JobDetails(EXAMPLE_LIST_ID, EXAMPLE_DATETIME)
+EXAMPLE_NUMBER_OF_BUCKETS = 4
 
 
-class TestSyncJob(unittest.TestCase):
+def example_mailchimp_member(index, first_name="First"):
+    return {
+        "id": f"member_{index}",
+        "email_address": f"member_{index}@example.com",
+        "status": "subscribed",
+        "merge_fields": {
+            "FNAME": first_name,
+            "LNAME": "Last"
+        }
+    }
+
+
+class MemberShadowTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Shadow files are written to a temporary directory instead of the working directory
+        self.temporary_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temporary_directory.cleanup)
+        patcher = patch('syncModule.PERSISTENCE_MEMBER_SHADOW_DIRECTORY_NAME',
+                        os.path.join(self.temporary_directory.name, "member_shadow_{}"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TestSyncJob(MemberShadowTestCase):
 
     @patch('api.mailchimpAPIModule.get_list_members')
     @patch('api.mailchimpAPIModule.get_list_members_count')
@@ -144,5 +188,290 @@ class TestSyncJob(unittest.TestCase):
         self.assertEqual(set(jobs.keys()), set(test_id_lists))
 
 
+class TestMemberShadow(MemberShadowTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for name, value in [('NUMBER_OF_MEMBER_SHADOW_BUCKETS', EXAMPLE_NUMBER_OF_BUCKETS),
+                            ('BULK_MEMBER_COUNT', 2)]:
+            patcher = patch(f'syncModule.{name}', value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.mailchimp_members = [example_mailchimp_member(index) for index in range(10)]
+        self.pushed_member_ids = []
+
+    def mock_mailchimp_and_ometria(self, mock_create_or_update_members, mock_get_list_members_count,
+                                   mock_get_list_members):
+        mock_get_list_members_count.side_effect = lambda list_id, since_last_changed=None: len(
+            self.mailchimp_members)
+        mock_get_list_members.side_effect = lambda list_id, page, count, since_last_changed: {
+            'members': self.mailchimp_members[(page - 1) * count:page * count]}
+        # The pushed list is cleared after each push, so its members are copied when pushed
+        mock_create_or_update_members.side_effect = lambda members: self.pushed_member_ids.append(
+            [member.id for member in members])
+
+    def expected_fingerprints(self):
+        return {mailchimp_member.get('id'): member_fingerprint(mailchimp_member_to_ometria_member(mailchimp_member))
+                for mailchimp_member in self.mailchimp_members}
+
+    def stored_fingerprints(self, bucket_count=EXAMPLE_NUMBER_OF_BUCKETS):
+        fingerprints = {}
+        for bucket in range(bucket_count):
+            fingerprints.update(open_member_shadow_bucket(EXAMPLE_LIST_ID, bucket, bucket_count))
+        return fingerprints
+
+    def record_mailchimp_members(self):
+        job_details = JobDetails(EXAMPLE_LIST_ID, EXAMPLE_DATETIME, EXAMPLE_DATETIME)
+        record_pushed_members(job_details, [mailchimp_member_to_ometria_member(mailchimp_member)
+                                            for mailchimp_member in self.mailchimp_members])
+        return job_details
+
+    def test_member_shadow_round_trip(self):
+        self.record_mailchimp_members()
+
+        # Recorded buckets have their digests cleared, until they're computed again
+        self.assertEqual(self.stored_fingerprints(), self.expected_fingerprints())
+        self.assertEqual(open_member_shadow_digests(EXAMPLE_LIST_ID), [None] * EXAMPLE_NUMBER_OF_BUCKETS)
+
+        digests = refresh_member_shadow_digests(EXAMPLE_LIST_ID)
+        self.assertEqual(open_member_shadow_digests(EXAMPLE_LIST_ID), digests)
+        for bucket in range(EXAMPLE_NUMBER_OF_BUCKETS):
+            self.assertEqual(digests[bucket], bucket_digest(open_member_shadow_bucket(EXAMPLE_LIST_ID, bucket)))
+
+        # Appending a newer fingerprint of a member replaces the older one
+        changed_member = mailchimp_member_to_ometria_member(example_mailchimp_member(3, "Changed"))
+        record_pushed_members(JobDetails(EXAMPLE_LIST_ID, EXAMPLE_DATETIME, EXAMPLE_DATETIME), [changed_member])
+        self.assertEqual(self.stored_fingerprints()[changed_member.id], member_fingerprint(changed_member))
+
+        # Changing the number of buckets moves every member to its new bucket
+        expected_fingerprints = self.stored_fingerprints()
+        with patch('syncModule.NUMBER_OF_MEMBER_SHADOW_BUCKETS', 3):
+            migrate_member_shadow(EXAMPLE_LIST_ID)
+            digests = refresh_member_shadow_digests(EXAMPLE_LIST_ID)
+
+            for bucket in range(3):
+                bucket_members = open_member_shadow_bucket(EXAMPLE_LIST_ID, bucket)
+                self.assertTrue(all(bucket_of(member_id, 3) == bucket for member_id in bucket_members))
+                self.assertEqual(digests[bucket], bucket_digest(bucket_members))
+
+        self.assertEqual(self.stored_fingerprints(3), expected_fingerprints)
+        self.assertEqual(os.listdir(os.path.join(self.temporary_directory.name, f"member_shadow_{EXAMPLE_LIST_ID}")),
+                         ["3"])
+
+    def test_append_after_interrupted_append(self):
+        append_member_shadow_bucket(EXAMPLE_LIST_ID, 0, {"member_a": "fingerprint_a"})
+        with open(member_shadow_bucket_file_name(EXAMPLE_LIST_ID, 0, EXAMPLE_NUMBER_OF_BUCKETS), 'a') as file:
+            file.write('["member_b", "finger')
+
+        self.assertEqual(open_member_shadow_bucket(EXAMPLE_LIST_ID, 0), {"member_a": "fingerprint_a"})
+
+        append_member_shadow_bucket(EXAMPLE_LIST_ID, 0, {"member_c": "fingerprint_c"})
+        self.assertEqual(open_member_shadow_bucket(EXAMPLE_LIST_ID, 0),
+                         {"member_a": "fingerprint_a", "member_c": "fingerprint_c"})
+
+    def test_corrupt_member_shadow_is_an_error(self):
+        append_member_shadow_bucket(EXAMPLE_LIST_ID, 0, {"member_a": "fingerprint_a"})
+        with open(member_shadow_bucket_file_name(EXAMPLE_LIST_ID, 0, EXAMPLE_NUMBER_OF_BUCKETS), 'w') as file:
+            file.write('["member_a", "finger\n["member_b", "fingerprint_b"]\n')
+
+        with self.assertRaises(MemberShadowError):
+            open_member_shadow_bucket(EXAMPLE_LIST_ID, 0)
+
+    def test_digests_of_another_bucket_count_are_an_error(self):
+        save_member_shadow_digests(EXAMPLE_LIST_ID, [0] * (EXAMPLE_NUMBER_OF_BUCKETS - 1))
+
+        with self.assertRaises(MemberShadowError):
+            open_member_shadow_digests(EXAMPLE_LIST_ID)
+
+    @patch('syncModule.get_list_members')
+    @patch('syncModule.get_list_members_count')
+    @patch('syncModule.create_or_update_members')
+    def test_sync_job_logic_records_pushed_members(self, mock_create_or_update_members,
+                                                   mock_get_list_members_count, mock_get_list_members):
+        self.mock_mailchimp_and_ometria(mock_create_or_update_members, mock_get_list_members_count,
+                                        mock_get_list_members)
+
+        result = sync_job_logic(JobDetails(EXAMPLE_LIST_ID, None))
+
+        self.assertTrue(result)
+        self.assertEqual(self.stored_fingerprints(), self.expected_fingerprints())
+
+    @patch('syncModule.get_list_members')
+    @patch('syncModule.get_list_members_count')
+    @patch('syncModule.create_or_update_members')
+    def test_sync_job_logic_succeeds_when_shadow_fails(self, mock_create_or_update_members,
+                                                       mock_get_list_members_count, mock_get_list_members):
+        self.mock_mailchimp_and_ometria(mock_create_or_update_members, mock_get_list_members_count,
+                                        mock_get_list_members)
+        save_member_shadow_digests(EXAMPLE_LIST_ID, [0] * (EXAMPLE_NUMBER_OF_BUCKETS - 1))
+        job_details = JobDetails(EXAMPLE_LIST_ID, EXAMPLE_DATETIME, EXAMPLE_DATETIME)
+
+        result = sync_job_logic(job_details)
+
+        # The members were pushed, only the next reconciliation is requested
+        self.assertTrue(result)
+        self.assertEqual(len(sum(self.pushed_member_ids, [])), len(self.mailchimp_members))
+        self.assertIsNone(job_details.last_reconciliation_date_time)
+
+    @patch('syncModule.get_list_members')
+    @patch('syncModule.get_list_members_count')
+    @patch('syncModule.create_or_update_members')
+    def test_reconcile_job_logic_pushes_only_drifted_members(self, mock_create_or_update_members,
+                                                            mock_get_list_members_count, mock_get_list_members):
+        self.mock_mailchimp_and_ometria(mock_create_or_update_members, mock_get_list_members_count,
+                                        mock_get_list_members)
+        self.record_mailchimp_members()
+
+        self.assertTrue(reconcile_job_logic(JobDetails(EXAMPLE_LIST_ID, EXAMPLE_DATETIME)))
+        self.assertEqual(sum(self.pushed_member_ids, []), [])
+
+        # A missed update, a missed member and a removed member
+        self.mailchimp_members[3] = example_mailchimp_member(3, "Changed")
+        self.mailchimp_members.append(example_mailchimp_member(10))
+        del self.mailchimp_members[5]
+
+        self.assertTrue(reconcile_job_logic(JobDetails(EXAMPLE_LIST_ID, EXAMPLE_DATETIME)))
+        self.assertEqual(sorted(sum(self.pushed_member_ids, [])), ["member_10", "member_3"])
+        self.assertEqual(self.stored_fingerprints(), self.expected_fingerprints())
+
+    @patch('syncModule.get_list_members')
+    @patch('syncModule.get_list_members_count')
+    @patch('syncModule.create_or_update_members')
+    def test_reconcile_job_logic_repairs_corrupt_bucket(self, mock_create_or_update_members,
+                                                       mock_get_list_members_count, mock_get_list_members):
+        self.mock_mailchimp_and_ometria(mock_create_or_update_members, mock_get_list_members_count,
+                                        mock_get_list_members)
+        self.record_mailchimp_members()
+        with open(member_shadow_bucket_file_name(EXAMPLE_LIST_ID, 2, EXAMPLE_NUMBER_OF_BUCKETS), 'w') as file:
+            file.write('corrupt\n')
+
+        self.assertTrue(reconcile_job_logic(JobDetails(EXAMPLE_LIST_ID, EXAMPLE_DATETIME)))
+
+        # Only the members of the corrupt bucket are pushed again
+        self.assertEqual(sum(self.pushed_member_ids, []),
+                         [mailchimp_member.get('id') for mailchimp_member in self.mailchimp_members
+                          if bucket_of(mailchimp_member.get('id'), EXAMPLE_NUMBER_OF_BUCKETS) == 2])
+        self.assertEqual(self.stored_fingerprints(), self.expected_fingerprints())
+
+    @patch('syncModule.get_list_members')
+    @patch('syncModule.get_list_members_count')
+    @patch('syncModule.create_or_update_members')
+    def test_reconcile_job_logic_caps_pushes_and_scans(self, mock_create_or_update_members,
+                                                       mock_get_list_members_count, mock_get_list_members):
+        self.mock_mailchimp_and_ometria(mock_create_or_update_members, mock_get_list_members_count,
+                                        mock_get_list_members)
+
+        # Nothing was ever recorded, so the whole list is pushed. The buckets hold 5, 3, 1 and 1 members,
+        # so with at most 4 members in memory they're reconciled in the groups [0], [1, 2] and [3].
+        with patch('syncModule.MAX_NUMBER_OF_MEMBERS_KEPT_IN_MEMORY', 4):
+            self.assertTrue(reconcile_job_logic(JobDetails(EXAMPLE_LIST_ID, EXAMPLE_DATETIME)))
+
+        self.assertTrue(all(len(pushed_member_ids) <= 2 for pushed_member_ids in self.pushed_member_ids))
+        self.assertEqual(sorted(sum(self.pushed_member_ids, [])), sorted(self.expected_fingerprints()))
+        # One scan for the digests, and one per group
+        self.assertEqual(mock_get_list_members_count.call_count, 4)
+
+    @patch('syncModule.get_list_members')
+    @patch('syncModule.get_list_members_count')
+    @patch('syncModule.create_or_update_members')
+    def test_failed_reconciliation_leaves_unpushed_buckets_untouched(self, mock_create_or_update_members,
+                                                                     mock_get_list_members_count,
+                                                                     mock_get_list_members):
+        self.mock_mailchimp_and_ometria(mock_create_or_update_members, mock_get_list_members_count,
+                                        mock_get_list_members)
+
+        # Every bucket is reconciled and pushed on its own, and ometria fails on the second push
+        def create_or_update_members(members):
+            if len(self.pushed_member_ids) > 0:
+                raise APIRequestError("Test Error")
+            self.pushed_member_ids.append([member.id for member in members])
+
+        mock_create_or_update_members.side_effect = create_or_update_members
+        with patch('syncModule.MAX_NUMBER_OF_MEMBERS_KEPT_IN_MEMORY', 1), patch('syncModule.BULK_MEMBER_COUNT', 100):
+            self.assertFalse(reconcile_job_logic(JobDetails(EXAMPLE_LIST_ID, EXAMPLE_DATETIME)))
+
+        self.assertEqual(set(self.stored_fingerprints()), set(self.pushed_member_ids[0]))
+        self.assertLess(len(self.stored_fingerprints()), len(self.mailchimp_members))
+
+    def test_is_reconciliation_needed(self):
+        recent_date_time = (datetime.now() - timedelta(minutes=5)).isoformat()
+        old_date_time = (datetime.now() - timedelta(days=2)).isoformat()
+
+        # Never synced, never reconciled, recently reconciled and reconciled a long time ago
+        self.assertFalse(is_reconciliation_needed(SyncJob(JobDetails(EXAMPLE_LIST_ID, None), Status.UNDEFINED)))
+        self.assertTrue(is_reconciliation_needed(SyncJob(JobDetails(EXAMPLE_LIST_ID, EXAMPLE_DATETIME),
+                                                         Status.PARTIALLY_SYNCED)))
+        self.assertFalse(is_reconciliation_needed(SyncJob(
+            JobDetails(EXAMPLE_LIST_ID, EXAMPLE_DATETIME, recent_date_time), Status.PARTIALLY_SYNCED)))
+        self.assertTrue(is_reconciliation_needed(SyncJob(
+            JobDetails(EXAMPLE_LIST_ID, EXAMPLE_DATETIME, old_date_time), Status.PARTIALLY_SYNCED)))
+
+        # A recent failed attempt delays the next one
+        self.assertFalse(is_reconciliation_needed(SyncJob(
+            JobDetails(EXAMPLE_LIST_ID, EXAMPLE_DATETIME, old_date_time, recent_date_time), Status.PARTIALLY_SYNCED)))
+        self.assertTrue(is_reconciliation_needed(SyncJob(
+            JobDetails(EXAMPLE_LIST_ID, EXAMPLE_DATETIME, old_date_time, old_date_time), Status.PARTIALLY_SYNCED)))
+
+    @patch('syncModule.sync_job_logic')
+    def test_launch_sync_job_first_sync_skips_reconciliation(self, mock_sync_job_logic):
+        mock_sync_job_logic.return_value = True
+
+        result = launch_sync_job(SyncJob(JobDetails(EXAMPLE_LIST_ID, None), Status.UNDEFINED))
+
+        self.assertEqual(result.job_details.last_reconciliation_date_time, result.job_details.last_sync_date_time)
+        self.assertFalse(is_reconciliation_needed(result))
+
+    @patch('syncModule.reconcile_job_logic')
+    def test_failed_reconciliation_is_not_retried_on_next_poll(self, mock_reconcile_job_logic):
+        mock_reconcile_job_logic.return_value = False
+        old_reconciliation_date_time = (datetime.now() - timedelta(days=2)).isoformat()
+        jobs = {EXAMPLE_LIST_ID: SyncJob(JobDetails(EXAMPLE_LIST_ID, EXAMPLE_DATETIME, old_reconciliation_date_time),
+                                         Status.PARTIALLY_SYNCED)}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            reconciliation_results = launch_reconciliations(jobs, {}, executor)
+            concurrent.futures.wait(reconciliation_results.values())
+            jobs, reconciliation_results = collect_reconciliations(jobs, reconciliation_results)
+
+            self.assertEqual(reconciliation_results, {})
+            self.assertEqual(jobs[EXAMPLE_LIST_ID].job_details.last_reconciliation_date_time,
+                             old_reconciliation_date_time)
+            self.assertIsNotNone(jobs[EXAMPLE_LIST_ID].job_details.last_reconciliation_attempt_date_time)
+
+            # The next poll does not start it again
+            self.assertEqual(launch_reconciliations(jobs, reconciliation_results, executor), {})
+        mock_reconcile_job_logic.assert_called_once()
+
+    @patch('syncModule.reconcile_job_logic')
+    def test_reconciliations_are_left_running_across_polls(self, mock_reconcile_job_logic):
+        reconciliation_can_finish = threading.Event()
+        mock_reconcile_job_logic.side_effect = lambda job_details: reconciliation_can_finish.wait(10)
+        jobs = {EXAMPLE_LIST_ID: SyncJob(JobDetails(EXAMPLE_LIST_ID, EXAMPLE_DATETIME), Status.PARTIALLY_SYNCED)}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            reconciliation_results = launch_reconciliations(jobs, {}, executor)
+            jobs, reconciliation_results = collect_reconciliations(jobs, reconciliation_results)
+            self.assertEqual(list(reconciliation_results), [EXAMPLE_LIST_ID])
+
+            reconciliation_can_finish.set()
+            concurrent.futures.wait(reconciliation_results.values())
+            jobs, reconciliation_results = collect_reconciliations(jobs, reconciliation_results)
+
+        self.assertEqual(reconciliation_results, {})
+        self.assertIsNotNone(jobs[EXAMPLE_LIST_ID].job_details.last_reconciliation_date_time)
+
+
+class TestMailchimpAPI(unittest.TestCase):
+
+    @patch('api.mailchimpAPIModule.make_request')
+    def test_get_list_members_offset(self, mock_make_request):
+        get_list_members(EXAMPLE_LIST_ID, page=1, count=BULK_MEMBER_COUNT)
+        get_list_members(EXAMPLE_LIST_ID, page=2, count=BULK_MEMBER_COUNT)
+
+        offsets = [call.args[3].get('offset') for call in mock_make_request.call_args_list]
+        self.assertEqual(offsets, [0, BULK_MEMBER_COUNT])
+
+
 if __name__ == '__main__':
     unittest.main()